@@ -1,14 +1,28 @@
 import os
-import json
+import re
+import html
+import sys
+import time
+import logging
 import asyncio
-from dataclasses import dataclass
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable, Sequence
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
 
-from telegram import Update
-from telegram.ext import Application, ContextTypes, MessageHandler, filters
+import httpx
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson 없으면 표준 json (bytes도 받음)
+    import json
+    _json_loads = json.loads
+from telegram import LinkPreviewOptions, Update
+from telegram.constants import ParseMode
+from telegram.ext import Application, ContextTypes, Defaults, MessageHandler, filters
+
+
+logger = logging.getLogger(__name__)
 
 
 # -----------------------------
@@ -18,6 +32,14 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
 
 PANDASCORE_BASE = "https://api.pandascore.co"
 DEFAULT_PER_PAGE = 10
+# 동시에 던진 API 호출 묶음(gather)의 전체 제한 시간(초)
+API_TIMEOUT = 15
+
+# 웹훅 모드: WEBHOOK_URL(공개 HTTPS 주소)이 있으면 run_webhook, 없으면 run_polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+PORT = int(os.getenv("PORT", "8080"))
+# 설정하면 Telegram이 X-Telegram-Bot-Api-Secret-Token 헤더로 보내고, 안 맞는 요청은 거절된다
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or None
 
 # ✅ 토큰은 "전역변수로 고정"하지 않고, 매번 getenv()로 읽는다 (Railway 변수 반영 문제 100% 방지)
 def get_pandascore_token() -> str:
@@ -27,12 +49,24 @@ def get_pandascore_token() -> str:
 # -----------------------------
 # Utilities
 # -----------------------------
+# PandaScore 기본 형식: "2024-05-01T09:00:00Z" (UTC). 이 모양이면 datetime 없이 잘라서 포맷.
+# 항상 유효한 값만 fast path로 받는다: 연 0001-9999, 월 01-12, 일 01-28(29-31은 달마다 달라서 fromisoformat이 검증),
+# 시 00-23, 분/초 00-59, 소수초 3자리 또는 6자리. 나머지는 전부 아래 fromisoformat 경로로 보낸다.
+_ISO_UTC_RE = re.compile(
+    r"(?!0000)\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|1\d|2[0-8])"
+    r"T(?:[01]\d|2[0-3]):[0-5]\d(?::[0-5]\d(?:\.\d{3}(?:\d{3})?)?)?Z"
+)
+# 3.11+ fromisoformat은 "Z"를 바로 파싱
+_FROMISO_Z = sys.version_info >= (3, 11)
+
 def _fmt_dt(iso_str: str | None) -> str:
     if not iso_str:
         return "시간 정보 없음"
+    if _ISO_UTC_RE.fullmatch(iso_str):
+        return f"{iso_str[:10]} {iso_str[11:16]} UTC"
     try:
-        # PandaScore는 보통 ISO8601 (UTC) 제공
-        dt = datetime.fromisoformat(iso_str.replace("Z", "+00:00"))
+        # 그 외(오프셋 포함 등)는 파싱해서 UTC로 변환
+        dt = datetime.fromisoformat(iso_str if _FROMISO_Z else iso_str.replace("Z", "+00:00"))
         # 한국시간(+9) 표시는 원하면 바꿔도 됨. 여기선 UTC 유지.
         return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
     except Exception:
@@ -49,58 +83,178 @@ def _safe_int(x, default=0):
 
 
 # -----------------------------
-# PandaScore HTTP (no extra deps)
+# Async TTL cache (LRU + 키별 singleflight)
 # -----------------------------
-async def ps_get(path: str, params: dict | None = None) -> list | dict:
-    token = get_pandascore_token()
-    if not token:
-        raise RuntimeError("NO_TOKEN")
+class AsyncTTLCache:
+    """TTL이 있는 LRU 캐시. 같은 키로 동시에 들어온 miss는 한 번의 fetch로 합친다."""
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        # 키 -> 진행 중인 fetch. 기다리는 쪽은 전부 이 Future 하나의 결과(또는 예외)를 같이 받는다
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    def _get(self, key: Hashable) -> tuple[bool, object]:
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def _set(self, key: Hashable, value: object, ttl: float) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def _load(self, key: Hashable, coro_factory: Callable[[], Awaitable], ttl: float):
+        value = await coro_factory()
+        self._set(key, value, ttl)
+        return value
+
+    def _done(self, key: Hashable, fut: asyncio.Future) -> None:
+        # 끝난 fetch는 바로 빼서, 실패했으면 다음 호출이 새 fetch 하나를 시작하게 한다
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        # 기다리던 쪽이 다 취소됐어도 "exception was never retrieved" 경고가 안 나게
+        if not fut.cancelled():
+            fut.exception()
+
+    async def get_or_set(self, key: Hashable, coro_factory: Callable[[], Awaitable], ttl: float):
+        hit, value = self._get(key)
+        if hit:
+            return value
+
+        fut = self._inflight.get(key)
+        if fut is None or fut.done():
+            fut = asyncio.ensure_future(self._load(key, coro_factory, ttl))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f: self._done(key, f))
+        # 한 호출자가 취소(wait_for 타임아웃 등)돼도 공유 fetch는 계속 돌게 shield
+        return await asyncio.shield(fut)
 
-    qs = ""
-    if params:
-        qs = "?" + urlencode(params, doseq=True)
 
-    url = f"{PANDASCORE_BASE}{path}{qs}"
-
-    def _do_request():
-        req = Request(
-            url,
+# -----------------------------
+# PandaScore HTTP (httpx: python-telegram-bot이 이미 쓰는 클라이언트)
+# -----------------------------
+# 요청마다 TCP+TLS를 새로 맺지 않도록 keep-alive 커넥션 풀을 가진 클라이언트 하나를 재사용한다.
+# 이벤트 루프 안에서 처음 쓸 때 만든다.
+_CLIENT: httpx.AsyncClient | None = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            base_url=PANDASCORE_BASE,
+            timeout=15,
             headers={
-                "Authorization": f"Bearer {token}",
                 "Accept": "application/json",
                 "User-Agent": "telegram-bot/1.0",
             },
-            method="GET",
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
         )
-        with urlopen(req, timeout=15) as resp:
-            data = resp.read().decode("utf-8", errors="ignore")
-            return json.loads(data)
+    return _CLIENT
+
+async def close_client(app: Application | None = None) -> None:
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+# 엔드포인트별 응답 캐시 TTL(초). 목록에 없는 경로는 _PS_DEFAULT_TTL
+_PS_TTL = {
+    "/lol/matches/upcoming": 60,
+    "/lol/matches/past": 300,
+    "/lol/teams": 600,
+}
+_PS_DEFAULT_TTL = 60
+
+# ps_get 응답 캐시 (팀 검색 등). 경기 목록은 _MATCHES_CACHE가 파싱된 형태로 따로 캐시한다.
+_PS_CACHE = AsyncTTLCache(maxsize=512)
+
+# gather/동시 업데이트로 요청이 몰려도 PandaScore 429가 안 나게 동시 요청 수를 제한
+PS_MAX_CONCURRENCY = int(os.getenv("PANDASCORE_MAX_CONCURRENCY", "10"))
+_PS_SEM = asyncio.Semaphore(PS_MAX_CONCURRENCY)
+_PS_SEM_LOGGED = False
+_PS_MAX_RETRY_WAIT = 5
 
+async def ps_get(path: str, params: dict | None = None) -> list | dict:
+    token = get_pandascore_token()
+    if not token:
+        raise RuntimeError("NO_TOKEN")
+
+    # 에러는 캐시하지 않는다 (예외는 get_or_set 밖으로 그대로 나감)
+    key = (path, tuple(sorted((params or {}).items())))
+    return await _PS_CACHE.get_or_set(
+        key,
+        lambda: _ps_fetch(path, params, token),
+        ttl=_PS_TTL.get(path, _PS_DEFAULT_TTL),
+    )
+
+async def _ps_request(path: str, params: dict | None, token: str) -> httpx.Response:
     try:
-        return await asyncio.to_thread(_do_request)
-    except HTTPError as e:
-        body = ""
-        try:
-            body = e.read().decode("utf-8", errors="ignore")
-        except Exception:
-            pass
-        raise RuntimeError(f"HTTP_{e.code}:{body[:400]}")
-    except URLError as e:
+        return await _get_client().get(
+            path,
+            params=params,
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    except httpx.RequestError as e:
         raise RuntimeError(f"URL_ERROR:{e}")
     except Exception as e:
         raise RuntimeError(f"REQ_ERROR:{e}")
 
+def _retry_after(resp: httpx.Response) -> float:
+    # Retry-After(초)를 따르되 최대 _PS_MAX_RETRY_WAIT초만 기다린다
+    try:
+        wait = float(resp.headers.get("Retry-After", 1))
+    except ValueError:
+        wait = 1.0
+    return max(0.0, min(wait, _PS_MAX_RETRY_WAIT))
+
+async def _ps_request_limited(path: str, params: dict | None, token: str) -> httpx.Response:
+    global _PS_SEM_LOGGED
+    if _PS_SEM.locked() and not _PS_SEM_LOGGED:
+        _PS_SEM_LOGGED = True
+        # logging 설정이 따로 없어서 warning이어야 기본(lastResort) 핸들러로 stderr에 찍힌다
+        logger.warning(
+            "PandaScore 동시 요청 한도(%d)에 도달해서 대기 중. 필요하면 PANDASCORE_MAX_CONCURRENCY를 올려줘.",
+            PS_MAX_CONCURRENCY,
+        )
+
+    async with _PS_SEM:
+        return await _ps_request(path, params, token)
+
+async def _ps_fetch(path: str, params: dict | None, token: str) -> list | dict:
+    resp = await _ps_request_limited(path, params, token)
+    if resp.status_code == 429:
+        # rate limit: 슬롯을 반납한 상태로 기다렸다가 한 번만 재시도
+        await asyncio.sleep(_retry_after(resp))
+        resp = await _ps_request_limited(path, params, token)
+
+    if resp.status_code >= 400:
+        raise RuntimeError(f"HTTP_{resp.status_code}:{resp.text[:400]}")
+
+    try:
+        # 응답 bytes를 그대로 파싱 (text 디코딩 단계 생략)
+        return _json_loads(resp.content)
+    except Exception as e:
+        raise RuntimeError(f"REQ_ERROR:{e}")
+
 
 # -----------------------------
 # Domain models
 # -----------------------------
-@dataclass
+@dataclass(slots=True)
 class Team:
     id: int
     name: str
     acronym: str | None = None
 
-@dataclass
+@dataclass(slots=True)
 class MatchInfo:
     id: int
     begin_at: str | None
@@ -110,62 +264,99 @@ class MatchInfo:
     winner_id: int | None
     status: str | None
     name: str | None
+    opponent_ids: frozenset[int] = field(default_factory=frozenset)  # 파싱 때 한 번만 계산
 
 
 # -----------------------------
 # PandaScore helpers (LoL 중심)
 # -----------------------------
+def _team_from(t: dict, q: str) -> Team:
+    return Team(id=_safe_int(t.get("id")), name=t.get("name") or q, acronym=t.get("acronym"))
+
+def _pick_best_team(q: str, cands: list[dict]) -> dict:
+    # 정확한 이름 -> 약자(대소문자 무시) -> 이름 부분일치 -> 첫 결과 순으로 고른다
+    qn = _norm(q)
+    normed = [(_norm(t.get("name")), _norm(t.get("acronym")), t) for t in cands]
+    for name, _, t in normed:
+        if name == qn:
+            return t
+    for _, acronym, t in normed:
+        if acronym == qn:
+            return t
+    for name, _, t in normed:
+        if qn in name:
+            return t
+    return cands[0]
+
 async def find_lol_team(query: str) -> Team | None:
     q = query.strip()
     if not q:
         return None
 
-    # 1) search[name]
-    data = await ps_get(
-        "/lol/teams",
-        params={
-            "search[name]": q,
-            "per_page": 10,
-        },
-    )
+    # search[name] 한 번으로 넉넉히 받아서 약자 매칭까지 클라이언트에서 처리
+    data = await ps_get("/lol/teams", params={"search[name]": q, "per_page": 25})
     if isinstance(data, list) and data:
-        t = data[0]
-        return Team(id=_safe_int(t.get("id")), name=t.get("name") or q, acronym=t.get("acronym"))
-
-    # 2) search[acronym] fallback
-    data2 = await ps_get(
-        "/lol/teams",
-        params={
-            "search[acronym]": q,
-            "per_page": 10,
-        },
-    )
+        return _team_from(_pick_best_team(q, data), q)
+
+    # 이름 검색 결과가 아예 없을 때만 search[acronym] fallback
+    data2 = await ps_get("/lol/teams", params={"search[acronym]": q, "per_page": 10})
     if isinstance(data2, list) and data2:
-        t = data2[0]
-        return Team(id=_safe_int(t.get("id")), name=t.get("name") or q, acronym=t.get("acronym"))
+        return _team_from(_pick_best_team(q, data2), q)
 
     return None
 
 def _parse_match(m: dict) -> MatchInfo:
+    # PandaScore id는 거의 항상 int라서 int면 그대로 쓰고, 아닐 때만 _safe_int로 변환
     opponents = []
     for o in (m.get("opponents") or []):
         opp = o.get("opponent") or {}
-        if opp.get("id") is not None:
-            opponents.append({"id": _safe_int(opp.get("id")), "name": opp.get("name") or "Unknown"})
+        oid = opp.get("id")
+        if oid is not None:
+            if type(oid) is not int:
+                oid = _safe_int(oid)
+            opponents.append({"id": oid, "name": opp.get("name") or "Unknown"})
+
+    mid = m.get("id")
+    if type(mid) is not int:
+        mid = _safe_int(mid)
+    winner_id = m.get("winner_id")
+    if winner_id is not None and type(winner_id) is not int:
+        winner_id = _safe_int(winner_id, None)
+
     league = (m.get("league") or {}).get("name")
-    serie = (m.get("serie") or {}).get("full_name") or (m.get("serie") or {}).get("name")
+    serie_d = m.get("serie") or {}
+    serie = serie_d.get("full_name") or serie_d.get("name")
     return MatchInfo(
-        id=_safe_int(m.get("id")),
+        id=mid,
         begin_at=m.get("begin_at"),
         league=league,
         serie=serie,
         opponents=opponents,
-        winner_id=_safe_int(m.get("winner_id"), None) if m.get("winner_id") is not None else None,
+        winner_id=winner_id,
         status=m.get("status"),
         name=m.get("name"),
+        opponent_ids=frozenset(o["id"] for o in opponents),
     )
 
-async def get_upcoming_matches_for_team(team: Team, limit: int = 5) -> list[MatchInfo]:
+# /lol/matches/* 는 raw JSON 대신 파싱된 MatchInfo 튜플만 캐시한다 (_PS_CACHE는 안 거침).
+# 같은 목록이 raw dict + MatchInfo로 두 번 메모리에 남지 않고, hit 때 _parse_match도 다시 안 돈다.
+# 튜플이라 호출부끼리 복사 없이 공유 (호출부는 수정하지 않음)
+_MATCHES_CACHE = AsyncTTLCache(maxsize=256)
+
+async def _ps_get_matches(path: str, params: dict) -> tuple[MatchInfo, ...]:
+    async def _load() -> tuple[MatchInfo, ...]:
+        token = get_pandascore_token()
+        if not token:
+            raise RuntimeError("NO_TOKEN")
+        data = await _ps_fetch(path, params, token)
+        if not isinstance(data, list):
+            return ()
+        return tuple(_parse_match(x) for x in data)
+
+    key = (path, tuple(sorted(params.items())))
+    return await _MATCHES_CACHE.get_or_set(key, _load, ttl=_PS_TTL.get(path, _PS_DEFAULT_TTL))
+
+async def get_upcoming_matches_for_team(team: Team, limit: int = 5) -> tuple[MatchInfo, ...]:
     # PandaScore 필터가 환경/버전에 따라 다를 수 있어서
     # 1) filter[opponent_id] 시도 -> 2) search[opponents.name] fallback
     params_try = [
@@ -175,15 +366,15 @@ async def get_upcoming_matches_for_team(team: Team, limit: int = 5) -> list[Matc
 
     for path, params in params_try:
         try:
-            data = await ps_get(path, params=params)
-            if isinstance(data, list) and data:
-                return [_parse_match(x) for x in data[:limit]]
+            matches = await _ps_get_matches(path, params)
+            if matches:
+                return matches[:limit]
         except Exception:
             continue
 
-    return []
+    return ()
 
-async def get_recent_matches_for_team(team: Team, limit: int = 10) -> list[MatchInfo]:
+async def get_recent_matches_for_team(team: Team, limit: int = 10) -> tuple[MatchInfo, ...]:
     params_try = [
         ("/lol/matches/past", {"filter[opponent_id]": team.id, "per_page": limit}),
         ("/lol/matches/past", {"search[opponents.name]": team.name, "per_page": limit}),
@@ -191,15 +382,57 @@ async def get_recent_matches_for_team(team: Team, limit: int = 10) -> list[Match
 
     for path, params in params_try:
         try:
-            data = await ps_get(path, params=params)
-            if isinstance(data, list) and data:
-                return [_parse_match(x) for x in data[:limit]]
+            matches = await _ps_get_matches(path, params)
+            if matches:
+                return matches[:limit]
         except Exception:
             continue
 
-    return []
+    return ()
+
+async def get_recent_matches_for_teams(teams: list[Team], per_team: int = 10) -> dict[int, Sequence[MatchInfo]]:
+    # 여러 팀 최근 경기를 filter[opponent_id]=A,B 한 번으로 받아서 팀별로 나눈다
+    buckets: dict[int, list[MatchInfo]] = {t.id: [] for t in teams}
+    try:
+        matches = await _ps_get_matches(
+            "/lol/matches/past",
+            {
+                "filter[opponent_id]": ",".join(str(tid) for tid in buckets),
+                # 팀별 경기 수가 딱 반반이 아니어도 각 팀이 per_team개를 채우도록 여유를 둔다
+                # (덜 차면 아래 단건 재요청이 묶음 요청 뒤에 순차로 붙어서 오히려 느려짐). PandaScore 최대 100.
+                "per_page": min(100, per_team * len(buckets) * 2),
+                "sort": "-begin_at",
+            },
+        )
+    except Exception:
+        matches = ()
 
-def calc_winrate(team: Team, matches: list[MatchInfo]) -> tuple[int, int, float]:
+    # filter[opponent_id]=A,B는 "둘 중 하나라도 참가"로 기대하지만, 결과가 전부 요청한 팀이 다 들어간
+    # 경기(=맞대결)뿐이면 "둘 다 참가"로 해석된 것으로 보고 버린다. 그대로 쓰면 양 팀 폼이 상대전적이 됨.
+    team_ids = frozenset(buckets)
+    if len(team_ids) > 1 and matches and all(team_ids <= m.opponent_ids for m in matches):
+        matches = ()
+
+    for m in matches:
+        for tid in m.opponent_ids:
+            bucket = buckets.get(tid)
+            if bucket is not None and len(bucket) < per_team:
+                bucket.append(m)
+
+    # 경기가 많은 팀이 묶음 결과를 다 차지하면 다른 팀은 per_team개를 못 채운다.
+    # 덜 찬 팀만 기존 단건 경로(이름 검색 fallback 포함)로 다시 받는다.
+    result: dict[int, Sequence[MatchInfo]] = dict(buckets)
+    short = [t for t in teams if len(buckets[t.id]) < per_team]
+    if short:
+        found = await asyncio.gather(*(get_recent_matches_for_team(t, limit=per_team) for t in short))
+        for t, matches in zip(short, found):
+            # 단건 결과가 더 적으면(조회 실패 등) 묶음에서 받은 것을 유지
+            if len(matches) >= len(buckets[t.id]):
+                result[t.id] = matches
+
+    return result
+
+def calc_winrate(team: Team, matches: Sequence[MatchInfo]) -> tuple[int, int, float]:
     # (wins, total, rate)
     total = 0
     wins = 0
@@ -208,8 +441,7 @@ def calc_winrate(team: Team, matches: list[MatchInfo]) -> tuple[int, int, float]
         if not m.winner_id:
             continue
         # 팀이 포함된 경기만 카운트(서치 fallback 때문에 가끔 섞일 수 있음)
-        ids = [o["id"] for o in m.opponents]
-        if team.id not in ids:
+        if team.id not in m.opponent_ids:
             continue
         total += 1
         if m.winner_id == team.id:
@@ -217,10 +449,16 @@ def calc_winrate(team: Team, matches: list[MatchInfo]) -> tuple[int, int, float]
     rate = (wins / total) if total else 0.0
     return wins, total, rate
 
-def predict_winner(team_a: Team, team_b: Team, recent_a: list[MatchInfo], recent_b: list[MatchInfo]) -> tuple[str, str]:
+def predict_winner(
+    team_a: Team,
+    team_b: Team,
+    stats_a: tuple[int, int, float],
+    stats_b: tuple[int, int, float],
+) -> tuple[str, str]:
     # 아주 단순 예측: 최근 N경기 승률 비교
-    wa, ta, ra = calc_winrate(team_a, recent_a)
-    wb, tb, rb = calc_winrate(team_b, recent_b)
+    # stats_*는 calc_winrate() 결과 (호출부에서 한 번만 계산해서 출력에도 같이 씀)
+    wa, ta, ra = stats_a
+    wb, tb, rb = stats_b
 
     # confidence 메시지
     diff = ra - rb
@@ -245,20 +483,160 @@ def predict_winner(team_a: Team, team_b: Team, recent_a: list[MatchInfo], recent
 # -----------------------------
 # Telegram: dot command router
 # -----------------------------
-HELP_TEXT = (
+# 기본 parse_mode가 HTML이라 <팀명> 같은 자리표시자는 escape 해둔다
+HELP_TEXT = html.escape(
     "🤖 Fakerbot (e스포츠/스포츠 분석)\n\n"
     "✅ 명령어(점(.)으로 시작)\n"
     "• .help : 도움말\n"
     "• .ping : 살아있나 확인\n"
     "• .team lol <팀명> : 팀 검색(LoL)\n"
-    "• .upcoming lol <팀명> : 다가오는 경기\n"
-    "• .match lol <팀A> <팀B> : 두 팀 비교 + 추천 승리팀(예측)\n\n"
+    "• .upcoming(.u) lol <팀명> : 다가오는 경기\n"
+    "• .match(.m) lol <팀A> <팀B> : 두 팀 비교 + 추천 승리팀(예측)\n\n"
     "예시)\n"
     "• .team lol T1\n"
     "• .upcoming lol T1\n"
     "• .match lol T1 gen\n"
 )
 
+# .upcoming 경기 한 건 렌더링 템플릿
+_UPCOMING_BLOCK = "• {time}\n  - {league} / {serie}\n  - 매치: {vs}"
+
+async def cmd_help(update: Update, args: list[str]):
+    await update.message.reply_text(HELP_TEXT)
+
+async def cmd_ping(update: Update, args: list[str]):
+    token_ok = "OK" if get_pandascore_token() else "NO_PANDASCORE_TOKEN"
+    await update.message.reply_text(f"pong ✅ (PANDASCORE_TOKEN={token_ok})")
+
+async def cmd_team(update: Update, args: list[str]):
+    # .team lol T1
+    if len(args) < 2:
+        await update.message.reply_text("사용법: .team lol &lt;팀명&gt;\n예: .team lol T1")
+        return
+    game = _norm(args[0])
+    q = " ".join(args[1:])
+    if game != "lol":
+        await update.message.reply_text("지금은 lol만 지원해. 예: .team lol T1")
+        return
+
+    team = await find_lol_team(q)
+    if not team:
+        await update.message.reply_text(f"팀을 못 찾았어: {html.escape(q)}")
+        return
+
+    await update.message.reply_text(
+        f"✅ 팀 찾음\n"
+        f"- 이름: {html.escape(team.name)}\n"
+        f"- 약자: {html.escape(team.acronym or '없음')}\n"
+        f"- ID: {team.id}"
+    )
+
+async def cmd_upcoming(update: Update, args: list[str]):
+    # .upcoming lol T1
+    if len(args) < 2:
+        await update.message.reply_text("사용법: .upcoming lol &lt;팀명&gt;\n예: .upcoming lol T1")
+        return
+    game = _norm(args[0])
+    q = " ".join(args[1:])
+    if game != "lol":
+        await update.message.reply_text("지금은 lol만 지원해. 예: .upcoming lol T1")
+        return
+
+    team = await find_lol_team(q)
+    if not team:
+        await update.message.reply_text(f"팀을 못 찾았어: {html.escape(q)}")
+        return
+
+    upcoming = await get_upcoming_matches_for_team(team, limit=5)
+    if not upcoming:
+        await update.message.reply_text(f"다가오는 경기 정보를 못 가져왔어. (팀: {html.escape(team.name)})")
+        return
+
+    blocks = [f"📅 {team.name} 다가오는 경기(최대 5개)"]
+    for m in upcoming:
+        opp_names = [o["name"] for o in m.opponents] or [m.name or "Unknown"]
+        blocks.append(
+            _UPCOMING_BLOCK.format(
+                time=_fmt_dt(m.begin_at),
+                league=m.league or "리그?",
+                serie=m.serie or "시리즈?",
+                vs=" vs ".join(opp_names),
+            )
+        )
+    # 경기마다 빈 줄 하나로 구분
+    await update.message.reply_text(html.escape("\n\n".join(blocks)))
+
+async def cmd_match(update: Update, args: list[str]):
+    # .match lol T1 gen
+    if len(args) < 3:
+        await update.message.reply_text("사용법: .match lol &lt;팀A&gt; &lt;팀B&gt;\n예: .match lol T1 gen")
+        return
+    game = _norm(args[0])
+    if game != "lol":
+        await update.message.reply_text("지금은 lol만 지원해. 예: .match lol T1 gen")
+        return
+
+    team_a_q = args[1]
+    team_b_q = args[2]
+
+    team_a, team_b = await asyncio.wait_for(
+        asyncio.gather(find_lol_team(team_a_q), find_lol_team(team_b_q)),
+        timeout=API_TIMEOUT,
+    )
+
+    if not team_a or not team_b:
+        await update.message.reply_text(
+            f"팀을 못 찾았어.\n"
+            f"- 팀A: {html.escape(team_a_q)} ({'OK' if team_a else 'NOT FOUND'})\n"
+            f"- 팀B: {html.escape(team_b_q)} ({'OK' if team_b else 'NOT FOUND'})"
+        )
+        return
+
+    # 최근 전적 기반 예측
+    buckets = await asyncio.wait_for(
+        get_recent_matches_for_teams([team_a, team_b], per_team=10),
+        timeout=API_TIMEOUT,
+    )
+    recent_a, recent_b = buckets[team_a.id], buckets[team_b.id]
+
+    stats_a = calc_winrate(team_a, recent_a)
+    stats_b = calc_winrate(team_b, recent_b)
+    winner, reason = predict_winner(team_a, team_b, stats_a, stats_b)
+    wa, ta, ra = stats_a
+    wb, tb, rb = stats_b
+
+    name_a = html.escape(team_a.name)
+    name_b = html.escape(team_b.name)
+    msg = (
+        f"🏟️ 매치업 분석 (LoL)\n"
+        f"{name_a} vs {name_b}\n\n"
+        f"📈 최근전적(최대 10경기 기준)\n"
+        f"- {name_a}: {wa}/{ta} ({ra:.0%})\n"
+        f"- {name_b}: {wb}/{tb} ({rb:.0%})\n\n"
+        f"⭐ 추천 승리팀(예측): <b>{html.escape(winner)}</b>\n"
+        f"{html.escape(reason)}\n\n"
+        f"※ 참고: 이건 단순 통계 기반 예측이라 확정 아님."
+    )
+    await update.message.reply_text(msg)
+
+# 점(.) 뒤 명령어 -> 핸들러. on_message는 dict lookup 한 번으로 분기한다.
+COMMANDS = {
+    "help": cmd_help,
+    "h": cmd_help,
+    "ping": cmd_ping,
+    "team": cmd_team,
+    "upcoming": cmd_upcoming,
+    "u": cmd_upcoming,
+    "match": cmd_match,
+    "m": cmd_match,
+}
+
+# 토큰 필요한 커맨드들 (핸들러 기준이라 별칭도 같이 걸린다)
+_PS_HANDLERS = frozenset({cmd_team, cmd_upcoming, cmd_match})
+
+# 명령어 인자는 많아야 몇 개라서, 거대한 메시지가 와도 split 결과를 이 개수로 제한
+_MAX_SPLIT = 10
+
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
         return
@@ -267,137 +645,36 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text.startswith("."):
         return
 
-    parts = text[1:].split()
+    parts = text[1:].split(maxsplit=_MAX_SPLIT)
     if not parts:
         return
 
     cmd = _norm(parts[0])
     args = parts[1:]
 
-    if cmd in ("help", "h"):
-        await update.message.reply_text(HELP_TEXT)
-        return
-
-    if cmd == "ping":
-        token_ok = "OK" if get_pandascore_token() else "NO_PANDASCORE_TOKEN"
-        await update.message.reply_text(f"pong ✅ (PANDASCORE_TOKEN={token_ok})")
+    handler = COMMANDS.get(cmd)
+    if handler is None:
+        # Unknown command
+        await update.message.reply_text("알 수 없는 명령어야. <code>.help</code> 쳐봐")
         return
 
-    # 토큰 필요한 커맨드들
-    if cmd in ("team", "upcoming", "match"):
+    if handler in _PS_HANDLERS:
         if not get_pandascore_token():
             await update.message.reply_text(
                 "❌ PandaScore 토큰이 없어.\n"
-                "Railway Variables에 `PANDASCORE_TOKEN` 추가하고, 컨테이너 재시작(또는 Redeploy) 해줘.\n"
-                "그리고 `.ping`로 토큰 OK 뜨는지 확인!"
+                "Railway Variables에 <code>PANDASCORE_TOKEN</code> 추가하고, 컨테이너 재시작(또는 Redeploy) 해줘.\n"
+                "그리고 <code>.ping</code>로 토큰 OK 뜨는지 확인!"
             )
             return
 
     try:
-        if cmd == "team":
-            # .team lol T1
-            if len(args) < 2:
-                await update.message.reply_text("사용법: .team lol <팀명>\n예: .team lol T1")
-                return
-            game = _norm(args[0])
-            q = " ".join(args[1:])
-            if game != "lol":
-                await update.message.reply_text("지금은 lol만 지원해. 예: .team lol T1")
-                return
-
-            team = await find_lol_team(q)
-            if not team:
-                await update.message.reply_text(f"팀을 못 찾았어: {q}")
-                return
-
-            await update.message.reply_text(
-                f"✅ 팀 찾음\n"
-                f"- 이름: {team.name}\n"
-                f"- 약자: {team.acronym or '없음'}\n"
-                f"- ID: {team.id}"
-            )
-            return
+        await handler(update, args)
 
-        if cmd == "upcoming":
-            # .upcoming lol T1
-            if len(args) < 2:
-                await update.message.reply_text("사용법: .upcoming lol <팀명>\n예: .upcoming lol T1")
-                return
-            game = _norm(args[0])
-            q = " ".join(args[1:])
-            if game != "lol":
-                await update.message.reply_text("지금은 lol만 지원해. 예: .upcoming lol T1")
-                return
-
-            team = await find_lol_team(q)
-            if not team:
-                await update.message.reply_text(f"팀을 못 찾았어: {q}")
-                return
-
-            upcoming = await get_upcoming_matches_for_team(team, limit=5)
-            if not upcoming:
-                await update.message.reply_text(f"다가오는 경기 정보를 못 가져왔어. (팀: {team.name})")
-                return
-
-            lines = [f"📅 {team.name} 다가오는 경기(최대 5개)"]
-            for m in upcoming:
-                opp_names = [o["name"] for o in m.opponents]
-                lines.append(
-                    f"\n• {_fmt_dt(m.begin_at)}\n"
-                    f"  - {m.league or '리그?'} / {m.serie or '시리즈?'}\n"
-                    f"  - 매치: {' vs '.join(opp_names) if opp_names else (m.name or 'Unknown')}"
-                )
-            await update.message.reply_text("\n".join(lines))
-            return
-
-        if cmd == "match":
-            # .match lol T1 gen
-            if len(args) < 3:
-                await update.message.reply_text("사용법: .match lol <팀A> <팀B>\n예: .match lol T1 gen")
-                return
-            game = _norm(args[0])
-            if game != "lol":
-                await update.message.reply_text("지금은 lol만 지원해. 예: .match lol T1 gen")
-                return
-
-            team_a_q = args[1]
-            team_b_q = args[2]
-
-            team_a = await find_lol_team(team_a_q)
-            team_b = await find_lol_team(team_b_q)
-
-            if not team_a or not team_b:
-                await update.message.reply_text(
-                    f"팀을 못 찾았어.\n"
-                    f"- 팀A: {team_a_q} ({'OK' if team_a else 'NOT FOUND'})\n"
-                    f"- 팀B: {team_b_q} ({'OK' if team_b else 'NOT FOUND'})"
-                )
-                return
-
-            # 최근 전적 기반 예측
-            recent_a = await get_recent_matches_for_team(team_a, limit=10)
-            recent_b = await get_recent_matches_for_team(team_b, limit=10)
-
-            winner, reason = predict_winner(team_a, team_b, recent_a, recent_b)
-
-            wa, ta, ra = calc_winrate(team_a, recent_a)
-            wb, tb, rb = calc_winrate(team_b, recent_b)
-
-            msg = (
-                f"🏟️ 매치업 분석 (LoL)\n"
-                f"{team_a.name} vs {team_b.name}\n\n"
-                f"📈 최근전적(최대 10경기 기준)\n"
-                f"- {team_a.name}: {wa}/{ta} ({ra:.0%})\n"
-                f"- {team_b.name}: {wb}/{tb} ({rb:.0%})\n\n"
-                f"⭐ 추천 승리팀(예측): **{winner}**\n"
-                f"{reason}\n\n"
-                f"※ 참고: 이건 단순 통계 기반 예측이라 확정 아님."
-            )
-            await update.message.reply_text(msg, parse_mode="Markdown")
-            return
-
-        # Unknown command
-        await update.message.reply_text("알 수 없는 명령어야. `.help` 쳐봐")
+    except asyncio.TimeoutError:
+        # API_TIMEOUT으로 묶은 gather가 시간 안에 안 끝난 경우
+        await update.message.reply_text(
+            f"⚠️ PandaScore가 {API_TIMEOUT}초 안에 응답하지 않았어. 잠시 후 다시 시도해줘."
+        )
         return
 
     except RuntimeError as e:
@@ -405,17 +682,17 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if s == "NO_TOKEN":
             await update.message.reply_text(
                 "❌ PandaScore 토큰이 없어.\n"
-                "Railway Variables에 `PANDASCORE_TOKEN` 추가하고 재시작(또는 Redeploy) 해줘.\n"
-                "그리고 `.ping`로 토큰 OK 확인!"
+                "Railway Variables에 <code>PANDASCORE_TOKEN</code> 추가하고 재시작(또는 Redeploy) 해줘.\n"
+                "그리고 <code>.ping</code>로 토큰 OK 확인!"
             )
             return
 
         # API 에러 상세 출력 (너가 디버깅하기 쉽게)
-        await update.message.reply_text(f"⚠️ API 오류: {s[:800]}")
+        await update.message.reply_text(f"⚠️ API 오류: {html.escape(s[:800])}")
         return
 
     except Exception as e:
-        await update.message.reply_text(f"⚠️ 오류: {type(e).__name__}: {str(e)[:800]}")
+        await update.message.reply_text(f"⚠️ 오류: {type(e).__name__}: {html.escape(str(e)[:800])}")
         return
 
 
@@ -423,9 +700,34 @@ def main():
     if not TOKEN:
         raise RuntimeError("TELEGRAM_BOT_TOKEN 환경변수가 없어!")
 
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
-    app.run_polling()
+    # reply_text마다 parse_mode 등을 넘기지 않도록 기본값을 한 번만 지정
+    defaults = Defaults(
+        parse_mode=ParseMode.HTML,
+        link_preview_options=LinkPreviewOptions(is_disabled=True),
+    )
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .defaults(defaults)
+        # 한 유저의 느린 PandaScore 호출이 다른 유저 업데이트를 막지 않도록 동시 처리.
+        # 핸들러 비차단(block=False)은 아래 add_handler에서만 지정한다.
+        # 공유 상태(AsyncTTLCache 캐시는 키별 in-flight Future, _PS_SEM 동시 요청 제한)는 전부 이벤트 루프 하나 위에 있어서 안전.
+        .concurrent_updates(True)
+        .post_shutdown(close_client)
+        .build()
+    )
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message, block=False))
+
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":